@@ -7,8 +7,19 @@ import uuid
 
 import requests
 
+try:
+    # orjson is optional, but parses the streamed response much faster
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
+
 BASE_URL = "https://chatgpt.duti.tech/"
 
+class GPTResponseError(Exception):
+    def __init__(self, status_code: int, text: str) -> None:
+        super().__init__(f"GPT: Response {status_code}: {text}")
+        self.status_code = status_code
+
 class GPT:
     def __init__(self, config) -> None:
         self.config = config
@@ -29,6 +40,14 @@ class GPT:
             },
         )
 
+    @staticmethod
+    def is_transient(error: Exception) -> bool:
+        """Whether a failed send is worth retrying (network errors, 429 and 5xx)."""
+        if isinstance(error, GPTResponseError):
+            return error.status_code == 429 or error.status_code >= 500
+        return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                                  requests.exceptions.ChunkedEncodingError))
+
     def __is_valid(self, data: dict) -> bool:
         try:
             data["message"]["content"]
@@ -54,12 +73,12 @@ class GPT:
         
         response = self.session.post(
             url=BASE_URL + "api/conversation",
-            data=json.dumps(data),
+            data=json_dumps(data),
             timeout=360,
             stream=True
         )
         if response.status_code != 200:
-            raise Exception(f"GPT: Response {response.status_code}: {response.text}")
+            raise GPTResponseError(response.status_code, response.text)
         
         for line in response.iter_lines():
             line = str(line)[2:-1]
@@ -68,7 +87,8 @@ class GPT:
             if line == "[DONE]": break
 
             line = line.replace('\\"', '"').replace("\\'", "'").replace("\\\\", "\\")
-            try: line = json.loads(line)
+            # orjson.JSONDecodeError subclasses json.decoder.JSONDecodeError
+            try: line = json_loads(line)
             except json.decoder.JSONDecodeError: continue
             
             if not self.__is_valid(line):
@@ -4,27 +4,98 @@
 
 
 import argparse
-import os
-import shlex
+import json
+import random
 import subprocess
 import sys
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import List, Optional, Tuple
 
-from src.GPT import GPT
 from src.prompts import PromptData, prompt_data
 
+# How long (in seconds) a cached response is served for
+DEFAULT_CACHE_TTL = 3600
+# osascript is run by absolute path and with close_fds=False, since subprocess
+# only uses its posix_spawn fast path (instead of fork + exec through
+# _posixsubprocess.fork_exec) when the executable has a directory and
+# close_fds is off. Python opens its own files as non-inheritable, so
+# osascript does not inherit anything extra.
+OSASCRIPT = "/usr/bin/osascript"
+# AppleScript that sends a message with the Messages app
+SEND_SCRIPT = 'tell application "Messages" to send "{message}" to buddy "{buddy}"'
+
+
+# ChatGPT clients by token, one set per thread: batch workers must not share
+# a client, since requests does not promise that a Session is thread-safe
+_chatbots = threading.local()
+
+
+def _get_chatbot(token: str):
+    """Get this thread's ChatGPT client for a token, reusing it across requests."""
+    clients = _chatbots.__dict__.setdefault("clients", {})
+    if token not in clients:
+        # Imported here so commands that never reach ChatGPT skip loading requests
+        from src.GPT import GPT  # pylint: disable=import-outside-toplevel
+        clients[token] = GPT(config={"access_token": token})
+    return clients[token]
+
+
+def is_valid_phone_number(number: str) -> bool:
+    """Check that the phone number is a string of 10 digits."""
+    return isinstance(number, str) and len(number) == 10 and number.isdigit()
+
+
+def phone_number(number: str) -> str:
+    """Validate a phone number given on the command line.
+
+    This lets argparse reject a bad number before any files are read.
+    """
+    if not is_valid_phone_number(number):
+        raise argparse.ArgumentTypeError(f"invalid phone number: {number!r} (expected 10 digits)")
+    return number
+
+
+def retry_count(value: str) -> int:
+    """Validate a number of retries given on the command line."""
+    try:
+        retries = int(value)
+    except ValueError:
+        retries = -1
+    if retries < 0:
+        raise argparse.ArgumentTypeError(f"invalid retry count: {value!r} (expected 0 or more)")
+    return retries
+
 
 class WingmanGPT:
     """Command-line tool that generates and sends text messages."""
 
-    def __init__(self, number: str, noconfirm: bool, token: str, message: str, mode: str) -> None:
+    def __init__(self, number: str, noconfirm: bool, token: str, message: str, mode: str,
+                 nocache: bool = False, cache_ttl: int = DEFAULT_CACHE_TTL, retries: int = 3,
+                 batch: bool = False) -> None:
         """Take a message, give it to chatGPT, send response to number."""
         # Command line arguments
         self.__phone_number = self.__get_phone_number(number)
         self.__token = self.__get_token(token)
         self.__message = self.__get_message(message)
         self.__confirm = not noconfirm
+        self.__use_cache = not nocache
+        self.__cache_ttl = cache_ttl
+        self.__retries = retries
+        # Batch responses are fetched concurrently, so their logs say who they are for
+        self.__log_prefix = f"[{number}] " if batch else ""
         self.__prompt_data: PromptData = prompt_data
         self.__mode_modification = self.__get_mode_modification(mode)
+        self.__mode = mode or self.__prompt_data.DEFAULT_MODE
+        self.__prompt = self.__get_prompt()
+        # Reused by every get_send_script call
+        self.__send_script_args = {"buddy": self.__phone_number, "message": ""}
+
+    def __log(self, message: str) -> None:
+        """Print a status message to stderr."""
+        print(f"{self.__log_prefix}{message}", file=sys.stderr)
 
     def __get_token(self, token: str) -> str:
         """Get the token to be used for the ChatGPT API.
@@ -37,26 +108,23 @@ class WingmanGPT:
         if isinstance(token, str) and token != "":
             return token
         # Now check to see if there is a token file
-        if os.path.exists("token"):
-            with open("token", "r", encoding='utf-8') as f:
-                tok = f.read()
-                if tok != "":
-                    return tok
+        try:
+            tok = Path("token").read_text(encoding='utf-8').strip()
+            if tok != "":
+                return tok
+        except FileNotFoundError:
+            pass
         # Now throw an error
         raise Exception("No token provided or found in token file")
 
     def __get_phone_number(self, number: str) -> str:
         """Get the phone number to send the message to.
 
-        If the phone nuber is not a string or is not 10 characters long,
+        If the phone nuber is not a string of 10 digits,
         it will throw an error.
         """
-        if not isinstance(number, str) or len(number) != 10:
+        if not is_valid_phone_number(number):
             raise Exception("Invalid phone number")
-        # Make sure all of the characters are digits
-        for char in number:
-            if not char.isdigit():
-                raise Exception("Invalid phone number")
         return number
 
     def __get_message(self, message: str) -> str:
@@ -69,12 +137,13 @@ class WingmanGPT:
         # First see if it is passed as an argument
         if isinstance(message, str) and message != "":
             return message
-        # Now check to see if there is a message.txt file
-        if os.path.exists("message"):
-            with open("message", "r", encoding='utf-8') as f:
-                msg = f.read()
-                if msg != "":
-                    return msg
+        # Now check to see if there is a message file
+        try:
+            msg = Path("message").read_text(encoding='utf-8').strip()
+            if msg != "":
+                return msg
+        except FileNotFoundError:
+            pass
         # Now throw an error
         raise Exception("No message provided or found in message")
 
@@ -84,8 +153,7 @@ class WingmanGPT:
         If no mode is provided, it will default to ROMANTIC.
         If an invalid mode is provided, it will throw an error.
         """
-        available_modes = \
-            {response_mode.NAME: response_mode.PROMPT_MODIFICATION for response_mode in self.__prompt_data.MODES}
+        available_modes = self.__prompt_data.MODES_BY_NAME
 
         if mode_str is None or mode_str == "":
             # Default
@@ -97,68 +165,207 @@ class WingmanGPT:
 
     def __get_prompt(self):
         """Get the prompt to be used for the ChatGPT API."""
-        prompt = ""
-        prompt += " ".join(self.__prompt_data.PREFIX)
-        prompt += f" Here is the message: \"{self.__message}\"."
-        prompt += " Here is how I want you to modify the message: "
-        prompt += f"\"{self.__mode_modification}\"."
-        prompt += " ".join(self.__prompt_data.SUFFIX)
-        return prompt
+        # PREFIX and SUFFIX are lists of sentences
+        return " ".join([
+            *self.__prompt_data.PREFIX,
+            f"Here is the message: \"{self.__message}\".",
+            f"Here is how I want you to modify the message: \"{self.__mode_modification}\".",
+            *self.__prompt_data.SUFFIX,
+        ])
 
     def __get_response(self):
         """Get the ChatGPT Response."""
         # Get the prompt to be used
-        prompt = self.__get_prompt()
+        prompt = self.__prompt
+        if not self.__use_cache:
+            return self.__ask(prompt)
+        # Imported here so argument errors and other commands skip loading sqlite3
+        from src.cache import ResponseCache  # pylint: disable=import-outside-toplevel
+        # Serve identical prompts, then near-duplicate messages, from the cache
+        with ResponseCache(ttl=self.__cache_ttl) as cache:
+            cached, tier = cache.get(prompt, self.__mode, self.__message)
+            self.__log(f"X-Cache: {'MISS' if cached is None else f'HIT ({tier})'}")
+            if cached is not None:
+                return cached
+            response = self.__ask(prompt)
+            # An empty reply is a failed request, so it is not cached
+            if response != "":
+                cache.put(prompt, self.__mode, self.__message, response)
+            return response
+
+    def __ask(self, prompt: str) -> str:
+        """Send the prompt to ChatGPT, retrying transient failures."""
         # Configure the ChatGPT API
         token = self.__token
         # strip any newlines from the token
         token = token.replace("\n", "")
-        chatbot = GPT(config={ "access_token": token })
-        response = ""
-        for data in chatbot.send(prompt):
-            response = data["message"]
-        response = response[1:-1]
-        return response
+        chatbot = _get_chatbot(token)
+        attempt = 0
+        while True:
+            try:
+                # Each streamed chunk holds the whole message so far, so only keep the last one
+                last = deque(chatbot.send(prompt), maxlen=1)
+                break
+            except Exception as e:
+                if attempt >= self.__retries or not chatbot.is_transient(e):
+                    raise
+                # Exponential backoff with jitter
+                delay = min(2 ** attempt, 8) + random.random()
+                self.__log(f"ChatGPT request failed, retrying in {delay:.1f}s...\n{e}")
+                time.sleep(delay)
+                attempt += 1
+        response = last[0]["message"] if last else ""
+        return response[1:-1]
+
+    @property
+    def phone_number(self) -> str:
+        """The phone number the message is sent to."""
+        return self.__phone_number
+
+    def get_send_script(self, response) -> str:
+        """Get the AppleScript that sends the response to the phone number."""
+        # Escape backslashes and double quotes for an AppleScript string.
+        # Two str.replace calls are much faster than str.translate here, since
+        # translate takes its slow path for one-to-many mappings.
+        self.__send_script_args["message"] = response.replace("\\", "\\\\").replace('"', '\\"')
+        return SEND_SCRIPT.format_map(self.__send_script_args)
 
     def __send_message(self, response):
         """Send message to phone number."""
-        # Properly escape special characters for a bash command
-        prepared_response = "\"" + shlex.quote(response)[1:-1] + "\""
-        # Send the message
-        command = "osascript -e 'tell application \"Messages\" to send "
-        command += f"{prepared_response} to buddy \"{self.__phone_number}\"'"
         try:
-            subprocess.run(command, shell=True, check=True)
+            subprocess.run([OSASCRIPT, "-e", self.get_send_script(response)], check=True, close_fds=False)
         except Exception as e:
             raise Exception(f"Failed to send message: \n\n{e}") from e
 
-    def execute(self):
-        """Execute the program.
-
-        This will first get the response from ChatGPT,
-        then it will ask the user if they want to send the message,
-        and then it will send the message.
-        """
+    def fetch_response(self):
+        """Get the response from ChatGPT, or None if it could not be fetched."""
         try:
-            print('Fetching response from ChatGPT...')
-            response = self.__get_response()
+            return self.__get_response()
         except Exception as e:
-            print(f'Failed to get response from ChatGPT API\n{e}', file=sys.stderr)
-            return
-        
+            self.__log(f'Failed to get response from ChatGPT API\n{e}')
+            return None
+
+    def confirm_response(self, response) -> bool:
+        """Ask the user if they want to send the response, unless noconfirm."""
+        if not self.__confirm:
+            return True
+        print(f"********\nTo: {self.__phone_number}\nMessage: {response}\n********")
+        confirm = input("Send message? (y/n): ")
+        if confirm.lower() != "y":
+            print("Message not sent.")
+            return False
+        return True
+
+    def send_response(self, response):
+        """Send the response, asking the user to confirm it first if needed."""
         try:
             print("Sending message...")
-            if self.__confirm:
-                print(f"********\nMessage: {response}\n********")
-                confirm = input("Send message? (y/n): ")
-                if confirm.lower() != "y":
-                    print("Message not sent.")
-                    return
+            if not self.confirm_response(response):
+                return
             self.__send_message(response)
             print('Message Sent.')
         except Exception as e:
             print(f'Failed to send message.\n{e}', file=sys.stderr)
 
+    def execute(self):
+        """Execute the program.
+
+        This will first get the response from ChatGPT,
+        then it will ask the user if they want to send the message,
+        and then it will send the message.
+        """
+        print('Fetching response from ChatGPT...')
+        response = self.fetch_response()
+        if response is None:
+            return
+        self.send_response(response)
+
+
+def load_batch(path: str) -> List[Tuple[int, dict]]:
+    """Load the entries of a batch file, with their line numbers.
+
+    Each line of the file is a JSON object with a "number" and optionally
+    a "message" and "mode", which default to the command line arguments.
+    """
+    entries = []
+    with open(path, "r", encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip() == "":
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise Exception(f"Invalid JSON on line {line_number} of {path}: {e}") from e
+            if not isinstance(entry, dict) or "number" not in entry:
+                raise Exception(f"Missing number on line {line_number} of {path}")
+            if not isinstance(entry["number"], str):
+                raise Exception(f"Number on line {line_number} of {path} must be a string, "
+                                f"e.g. \"1234567890\"")
+            entries.append((line_number, entry))
+    return entries
+
+
+def send_scripts(scripts: List[str]) -> List[Optional[str]]:
+    """Run several AppleScripts through a single osascript process.
+
+    This saves starting osascript, and connecting it to Messages,
+    once per message. Each script runs in its own try block, so one
+    failed send does not stop the rest. Returns, for each script, None
+    if it ran or the error it failed with.
+    """
+    # Each script logs (to stderr) whether it ran, tagged with its index
+    program = "".join(
+        f'try\n{script}\nlog "SENT {i}"\n'
+        f'on error errorMessage\nlog "FAILED {i}: " & errorMessage\nend try\n'
+        for i, script in enumerate(scripts)
+    )
+    with subprocess.Popen([OSASCRIPT], stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+                          text=True, close_fds=False) as osa:
+        _, log = osa.communicate(program)
+    # Scripts that never logged anything did not run at all
+    not_run = f"Not sent: osascript returned {osa.returncode}"
+    if log.strip() != "":
+        not_run += f"\n{log.strip()}"
+    results = [not_run] * len(scripts)
+    for line in log.splitlines():
+        status, _, rest = line.partition(" ")
+        index, _, error = rest.partition(": ")
+        if status in ("SENT", "FAILED") and index.isdigit() and int(index) < len(scripts):
+            results[int(index)] = None if status == "SENT" else error
+    return results
+
+
+def execute_batch(tgpts: List[WingmanGPT], max_workers: int = 8):
+    """Execute the program for several messages.
+
+    The ChatGPT responses are fetched concurrently, since each request
+    spends nearly all of its time waiting on the network. The messages
+    are then confirmed one at a time and sent together.
+    """
+    # Imported here since concurrent.futures (and the logging it pulls in) is only needed for batches
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+    print(f'Fetching {len(tgpts)} responses from ChatGPT...')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses = list(executor.map(WingmanGPT.fetch_response, tgpts))
+    numbers, scripts = [], []
+    for tgpt, response in zip(tgpts, responses):
+        if response is not None and tgpt.confirm_response(response):
+            numbers.append(tgpt.phone_number)
+            scripts.append(tgpt.get_send_script(response))
+    if not scripts:
+        return
+    try:
+        print(f"Sending {len(scripts)} messages...")
+        results = send_scripts(scripts)
+    except Exception as e:
+        print(f'Failed to send messages.\n{e}', file=sys.stderr)
+        return
+    for number, error in zip(numbers, results):
+        if error is None:
+            print(f'Message sent to {number}.')
+        else:
+            print(f'Failed to send message to {number}.\n{error}', file=sys.stderr)
+
 
 def make_token(token):
     """Make a file named token with the token in it."""
@@ -180,11 +387,19 @@ def main():
 
     # Create parser for normal usage
     send_parser = subparsers.add_parser('send', help="Compute and send a message.")
-    send_parser.add_argument('-n', '--number', required=True, help='Phone number to send the message to.')
+    recipient_group = send_parser.add_mutually_exclusive_group(required=True)
+    recipient_group.add_argument('-n', '--number', type=phone_number, help='Phone number to send the message to.')
+    recipient_group.add_argument('--batch', metavar='FILE',
+                                 help='JSONL file of messages to send, one {"number", "message", "mode"} per line.')
     send_parser.add_argument('-t', '--token', help='ChatGPT API token.')
     send_parser.add_argument('--mode', help='Mode to use for sending the message.')
     send_parser.add_argument('--noconfirm', action='store_true', help='Do not confirm before sending the message.')
     send_parser.add_argument('-m', '--message', help='Message to send.')
+    send_parser.add_argument('--no-cache', action='store_true', help='Do not use cached ChatGPT responses.')
+    send_parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL,
+                             help='Seconds a cached ChatGPT response is used for.')
+    send_parser.add_argument('--retries', type=retry_count, default=3,
+                             help='Times to retry a ChatGPT request that failed with a network or server error.')
 
     # Create parser for make-token command
     make_token_parser = subparsers.add_parser('make-token', help='Create a token file.')
@@ -202,9 +417,22 @@ def main():
     if args.command == 'send':
         # Handle send command
         try:
-            tgpt = WingmanGPT(number=args.number, noconfirm=args.noconfirm, token=args.token,
-                            message=args.message, mode=args.mode)
-            tgpt.execute()
+            if args.batch:
+                tgpts = []
+                for line_number, entry in load_batch(args.batch):
+                    try:
+                        tgpts.append(WingmanGPT(number=entry["number"], noconfirm=args.noconfirm, token=args.token,
+                                                message=entry.get("message", args.message),
+                                                mode=entry.get("mode", args.mode), nocache=args.no_cache,
+                                                cache_ttl=args.cache_ttl, retries=args.retries, batch=True))
+                    except Exception as e:
+                        raise Exception(f"Invalid entry on line {line_number} of {args.batch}: {e}") from e
+                execute_batch(tgpts)
+            else:
+                tgpt = WingmanGPT(number=args.number, noconfirm=args.noconfirm, token=args.token,
+                                message=args.message, mode=args.mode, nocache=args.no_cache,
+                                cache_ttl=args.cache_ttl, retries=args.retries)
+                tgpt.execute()
         except Exception as e:
             print(f"Error occurred:\n{e}", file=sys.stderr)
     elif args.command == 'make-token':
@@ -0,0 +1,168 @@
+"""Response cache used for WingmanGPT."""
+
+# pylint: disable=broad-exception-caught
+
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Optional, Tuple
+
+try:
+    import ollama
+    import sqlite_vec
+except ImportError:
+    ollama = None
+    sqlite_vec = None
+
+# Where cached responses are stored
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "wingmangpt")
+# Local model used to embed messages
+EMBEDDING_MODEL = "nomic-embed-text"
+# Messages closer than this (cosine distance) are treated as the same message
+MAX_DISTANCE = 0.05
+
+
+class ResponseCache:
+    """Disk-backed cache of ChatGPT responses.
+
+    Lookups go through two tiers. The exact tier matches the SHA256 of the
+    prompt, which is cheap and catches plain re-runs. Only on a miss is the
+    user's message embedded for the semantic tier, which matches
+    near-duplicate messages within the same mode. Only the message is
+    embedded because the rest of the prompt is the same fixed text every
+    time and would swamp it. The semantic tier needs the optional
+    ollama and sqlite-vec packages (and a running ollama server); without
+    them only the exact tier is used. Database errors never escape: a
+    failed lookup is a miss and a failed write is skipped.
+    """
+
+    def __init__(self, ttl: int, path: Optional[str] = None) -> None:
+        """Open (and create if needed) the cache database.
+
+        Responses older than ttl seconds are not served.
+        """
+        self.__ttl = ttl
+        self.__path = path or os.path.join(CACHE_DIR, "cache.db")
+        self.__embeddings = {}
+        self.__semantic = False
+        self.__conn = self.__connect()
+
+    def __enter__(self) -> "ResponseCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the cache database."""
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+
+    def __connect(self) -> Optional[sqlite3.Connection]:
+        """Connect to the database, loading sqlite-vec if possible."""
+        try:
+            os.makedirs(os.path.dirname(self.__path), exist_ok=True)
+            conn = sqlite3.connect(self.__path)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS exact ("
+                "key TEXT PRIMARY KEY, response TEXT, ts INTEGER)"
+            )
+            # Older caches embedded the whole prompt, so those rows are useless
+            conn.execute("DROP TABLE IF EXISTS semantic")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_message ("
+                "embedding BLOB, mode TEXT, message TEXT, response TEXT, ts INTEGER)"
+            )
+        except Exception:
+            return None
+        if ollama is not None and sqlite_vec is not None:
+            try:
+                conn.enable_load_extension(True)
+                sqlite_vec.load(conn)
+                conn.enable_load_extension(False)
+                self.__semantic = True
+            except Exception:
+                # Python builds without extension loading only get the exact tier
+                pass
+        return conn
+
+    def __embed(self, message: str) -> Optional[bytes]:
+        """Embed the message, reusing the embedding for repeat calls."""
+        if message not in self.__embeddings:
+            try:
+                emb = ollama.embeddings(model=EMBEDDING_MODEL, prompt=message)["embedding"]
+                self.__embeddings[message] = sqlite_vec.serialize_float32(emb)
+            except Exception:
+                # No ollama server running (or model not pulled)
+                return None
+        return self.__embeddings[message]
+
+    def get(self, prompt: str, mode: str, message: str) -> Tuple[Optional[str], Optional[str]]:
+        """Get the cached response for a prompt and the tier that hit.
+
+        The tier is "exact" or "semantic", and both are None on a miss.
+        Database errors (such as a locked database) are treated as a miss.
+        """
+        if self.__conn is None:
+            return None, None
+        try:
+            return self.__lookup(prompt, mode, message)
+        except sqlite3.Error:
+            return None, None
+
+    def __lookup(self, prompt: str, mode: str, message: str) -> Tuple[Optional[str], Optional[str]]:
+        """Look the prompt up in the exact tier, then the message in the semantic tier."""
+        oldest = int(time.time()) - self.__ttl
+        key = hashlib.sha256(prompt.encode()).hexdigest()
+        row = self.__conn.execute(
+            "SELECT response FROM exact WHERE key = ? AND ts > ? AND response != ''", (key, oldest)
+        ).fetchone()
+        if row:
+            return row[0], "exact"
+        if not self.__semantic:
+            return None, None
+        emb = self.__embed(message)
+        if emb is None:
+            return None, None
+        row = self.__conn.execute(
+            "SELECT response FROM semantic_message"
+            " WHERE mode = ? AND ts > ? AND response != '' AND vec_distance_cosine(embedding, ?) < ?"
+            " ORDER BY vec_distance_cosine(embedding, ?) LIMIT 1",
+            (mode, oldest, emb, MAX_DISTANCE, emb),
+        ).fetchone()
+        if row:
+            return row[0], "semantic"
+        return None, None
+
+    def put(self, prompt: str, mode: str, message: str, response: str) -> None:
+        """Store the response for a prompt in both tiers.
+
+        Responses older than the TTL are removed in the same transaction.
+        Empty responses are not cached, and database errors are ignored;
+        the response just is not cached.
+        """
+        if self.__conn is None or response == "":
+            return
+        now = int(time.time())
+        key = hashlib.sha256(prompt.encode()).hexdigest()
+        emb = self.__embed(message) if self.__semantic else None
+        oldest = now - self.__ttl
+        try:
+            with self.__conn:
+                # Drop expired rows, so the semantic scan does not grow forever
+                self.__conn.execute("DELETE FROM exact WHERE ts <= ?", (oldest,))
+                self.__conn.execute("DELETE FROM semantic_message WHERE ts <= ?", (oldest,))
+                self.__conn.execute(
+                    "INSERT OR REPLACE INTO exact (key, response, ts) VALUES (?, ?, ?)",
+                    (key, response, now),
+                )
+                if emb is not None:
+                    self.__conn.execute(
+                        "INSERT INTO semantic_message (embedding, mode, message, response, ts)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (emb, mode, message, response, now),
+                    )
+        except sqlite3.Error:
+            pass
@@ -7,6 +7,8 @@ from typing import List
 @dataclass
 class ResponseMode():
     """ResponseMode is a dataclass that holds the data for a response mode."""
+    # dataclass(slots=True) needs Python 3.10
+    __slots__ = ("NAME", "DESCRIPTION", "PROMPT_MODIFICATION")
     NAME: str
     DESCRIPTION: str
     PROMPT_MODIFICATION: str
@@ -15,11 +17,17 @@ class ResponseMode():
 @dataclass
 class PromptData:
     """PromptData is a dataclass that holds the data for a prompt."""
-    PREFIX: str
-    SUFFIX: str
+    # MODES_BY_NAME is built from MODES rather than being a field
+    __slots__ = ("PREFIX", "SUFFIX", "MODES", "DEFAULT_MODE", "MODES_BY_NAME")
+    PREFIX: List[str]
+    SUFFIX: List[str]
     MODES: List[ResponseMode]
     DEFAULT_MODE: str
 
+    def __post_init__(self):
+        """Map each mode name to its prompt modification."""
+        self.MODES_BY_NAME = {mode.NAME: mode.PROMPT_MODIFICATION for mode in self.MODES}
+
     def show_modes(self):
         """Show the modes."""
         print('AVAILABLE MODES:')